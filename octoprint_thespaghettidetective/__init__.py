@@ -52,6 +52,7 @@ class TheSpaghettiDetectivePlugin(
     def __init__(self):
         self.ss = None
         self.last_status_update_ts = 0
+        self.sentry = SentryWrapper(self)
         self.remote_status = RemoteStatus()
         self.commander = Commander()
         self.error_tracker = ConnectionErrorTracker(self)
@@ -152,6 +153,7 @@ class TheSpaghettiDetectivePlugin(
         if command == "toggle_sentry_opt":
             self._settings.set(["sentry_opt"], 'out' if self._settings.get(["sentry_opt"]) == 'in' else 'in', force=True)
             self._settings.save(force=True)
+            self.sentry.refresh()   # invalidate the memoized opt-out so the change takes effect immediately
 
     ##~~ Eventhandler mixin
 
@@ -8,11 +8,7 @@ import sarge
 import sys
 import flask
 from collections import deque
-try:
-   import queue
-except ImportError:
-   import Queue as queue
-from threading import Thread, RLock
+from threading import Thread, Condition
 import requests
 import yaml
 import backoff
@@ -34,6 +30,8 @@ JANUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin', 'jan
 
 JANUS_SERVER = os.getenv('JANUS_SERVER', '127.0.0.1')
 
+_CONTENT_LEN_RE = re.compile(br"Content-Length: (\d+)")
+
 PI_CAM_RESOLUTIONS = {
     'low': ((320,240), (480, 270)), # resolution for 4:3 and 16:9
     'medium': ((640, 480), (960, 540)),
@@ -67,14 +65,14 @@ class WebcamStreamer:
         self.shutting_down = False
 
     @backoff.on_exception(backoff.expo, Exception, max_tries=5)
-    def __init_camera__(self):
+    def __init_camera__(self, cfg):
         import picamera
         try:
             using_pi_camera()
             self.pi_camera = picamera.PiCamera()
             self.pi_camera.framerate=20
-            (res_43, res_169) = PI_CAM_RESOLUTIONS[self.plugin._settings.get(["pi_cam_resolution"])]
-            self.pi_camera.resolution = res_169 if self.plugin._settings.effective['webcam'].get('streamRatio', '4:3') == '16:9' else res_43
+            (res_43, res_169) = PI_CAM_RESOLUTIONS[cfg['pi_cam_resolution']]
+            self.pi_camera.resolution = res_169 if cfg['stream_ratio'] == '16:9' else res_43
             self.bitrate = bitrate_for_dim(self.pi_camera.resolution[0], self.pi_camera.resolution[1])
             _logger.debug('Pi Camera: framerate: {} - bitrate: {} - resolution: {}'.format(self.pi_camera.framerate, self.bitrate, self.pi_camera.resolution))
         except picamera.exc.PiCameraError:
@@ -95,25 +93,32 @@ class WebcamStreamer:
             return
 
         try:
-            compatible_mode = self.plugin._settings.get(["video_streaming_compatible_mode"])
-
-            if compatible_mode == 'always':
-                self.start_janus()
+            # Snapshot the settings we need once - each _settings.get walks the config tree
+            settings = self.plugin._settings
+            cfg = dict(
+                compatible_mode=settings.get(["video_streaming_compatible_mode"]),
+                pi_cam_resolution=settings.get(["pi_cam_resolution"]),
+                auth_token=settings.get(["auth_token"]),
+                stream_ratio=settings.effective['webcam'].get('streamRatio', '4:3'),
+            )
+
+            if cfg['compatible_mode'] == 'always':
+                self.start_janus(cfg['auth_token'])
                 self.ffmpeg_from_mjpeg()
                 return
 
             sarge.run('sudo service webcamd stop')
 
-            self. __init_camera__()
+            self. __init_camera__(cfg)
 
             # Use GStreamer for USB Camera. When it's used for Pi Camera it has problems (video is not playing. Not sure why)
             if not self.pi_camera:
-                self.start_janus()
+                self.start_janus(cfg['auth_token'])
 
                 try:
                     self.start_gst()
                 except:
-                    if compatible_mode == 'never':
+                    if cfg['compatible_mode'] == 'never':
                         raise
                     self.ffmpeg_from_mjpeg()
                     return
@@ -125,7 +130,7 @@ class WebcamStreamer:
 
             # Use ffmpeg for Pi Camera. When it's used for USB Camera it has problems (SPS/PPS not sent in-band?)
             else:
-                self.start_janus()
+                self.start_janus(cfg['auth_token'])
                 self.start_ffmpeg('-re -i pipe:0 -flags:v +global_header -c:v copy', via_wrapper=False) # script wrapper would break stdin pipe
 
                 self.webcam_server = PiCamWebServer(self.pi_camera)
@@ -146,17 +151,23 @@ class WebcamStreamer:
         if self.janus_ws and self.janus_ws.connected():
             self.janus_ws.send_text(msg)
 
-    def start_janus(self):
+    def start_janus(self, auth_token):
 
         def ensure_janus_config():
             janus_conf_tmp = os.path.join(JANUS_DIR, 'etc/janus/janus.jcfg.template')
             janus_conf_path = os.path.join(JANUS_DIR, 'etc/janus/janus.jcfg')
             with open(janus_conf_tmp, "rt") as fin:
-                with open(janus_conf_path, "wt") as fout:
-                    for line in fin:
-                        line = line.replace('{JANUS_HOME}', JANUS_DIR)
-                        line = line.replace('{TURN_CREDENTIAL}', self.plugin._settings.get(["auth_token"]))
-                        fout.write(line)
+                conf = fin.read().replace('{JANUS_HOME}', JANUS_DIR).replace('{TURN_CREDENTIAL}', auth_token)
+
+            try:
+                with open(janus_conf_path, "rt") as existing:
+                    if existing.read() == conf:   # config unchanged since last run - skip the write
+                        return
+            except IOError:
+                pass
+
+            with open(janus_conf_path, "wt") as fout:
+                fout.write(conf)
 
         def run_janus():
             janus_backoff = ExpoBackoff(60*1)
@@ -352,10 +363,16 @@ class UsbCamWebServer:
 
     def mjpeg_generator(self):
        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+       s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 256*1024)
+       buf = bytearray(64*1024)   # read in large chunks - fewer syscalls and response writes per frame
+       mv = memoryview(buf)
        try:
            s.connect(('127.0.0.1', 14499))
            while True:
-               yield s.recv(1024)
+               n = s.recv_into(buf)
+               if not n:
+                   break
+               yield mv[:n].tobytes()
        except GeneratorExit:
            pass
        finally:
@@ -372,15 +389,24 @@ class UsbCamWebServer:
        try:
            s.connect(('127.0.0.1', 14499))
            chunk = s.recv(100)
-           header = re.search(r"Content-Length: (\d+)", chunk.decode("iso-8859-1"), re.MULTILINE)
+           header = _CONTENT_LEN_RE.search(chunk)   # search the raw bytes - no decode copy
            if not header:
                raise Exception('Multiart header not found!')
 
            length = int(header.group(1))
-           chunk = bytearray(chunk[header.end()+4:])
-           while length > len(chunk):
-               chunk.extend(s.recv(length-len(chunk)))
-           return chunk[:length]
+           body = bytearray(length)       # preallocate once and recv_into its tail - no per-read growth
+           view = memoryview(body)
+           pos = min(length, len(chunk) - (header.end()+4))
+           if pos > 0:
+               view[:pos] = chunk[header.end()+4:header.end()+4+pos]
+           else:
+               pos = 0
+           while pos < length:
+               received = s.recv_into(view[pos:])
+               if not received:
+                   break
+               pos += received
+           return body
        except (socket.timeout, socket.error):
            exc_type, exc_obj, exc_tb = sys.exc_info()
            _logger.error(exc_obj)
@@ -412,52 +438,80 @@ class UsbCamWebServer:
         cam_server_thread.start()
 
 
+class _JpegFrameSink(io.RawIOBase):
+    # Collects the encoder's writes in a reusable bytearray, avoiding the
+    # seek/read/truncate round-trip a BytesIO costs per captured frame.
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buf.extend(b)
+        return len(b)
+
+    def pop_frame(self):
+        frame = bytes(self._buf)
+        del self._buf[:]
+        return frame
+
+
 class PiCamWebServer:
     def __init__(self, camera):
         self.pi_camera = camera
-        self.img_q = queue.Queue(maxsize=1)
-        self.last_capture = 0
-        self._mutex = RLock()
+        self._frame_cv = Condition()
+        self._latest_frame = None
+        self._frame_id = 0
         self.web_server = None
 
     def capture_forever(self):
-        bio = io.BytesIO()
-        for foo in self.pi_camera.capture_continuous(bio, format='jpeg', use_video_port=True):
-            bio.seek(0)
-            chunk = bio.read()
-            bio.seek(0)
-            bio.truncate()
-
-            with self._mutex:
-                last_last_capture = self.last_capture
-                self.last_capture = time.time()
-
-            self.img_q.put(chunk)
+        sink = _JpegFrameSink()
+        for foo in self.pi_camera.capture_continuous(sink, format='jpeg', use_video_port=True):
+            chunk = sink.pop_frame()   # the frame is complete at each iteration boundary
+
+            # Publish to a single latest-frame slot. Slow consumers miss frames
+            # instead of back-pressuring the capture loop and picamera's encoder.
+            with self._frame_cv:
+                self._latest_frame = chunk
+                self._frame_id += 1
+                self._frame_cv.notify_all()
+
+    def _next_frame(self, last_frame_id):
+        with self._frame_cv:
+            while self._frame_id == last_frame_id:
+                self._frame_cv.wait()
+            return (self._frame_id, self._latest_frame)
 
     def mjpeg_generator(self, boundary):
       try:
-        hdr = '--%s\r\nContent-Type: image/jpeg\r\n' % boundary
+        hdr = ('--%s\r\nContent-Type: image/jpeg\r\nContent-Length: ' % boundary).encode('iso-8859-1')
 
-        prefix = ''
+        prefix = b''
+        last_frame_id = 0
+        last_yield = 0
+        min_interval = 0.15 # cap mjpeg streaming framerate so that it won't use too much cpu or bandwidth
         while True:
-            chunk = self.img_q.get()
-            msg = prefix + hdr + 'Content-Length: {}\r\n\r\n'.format(len(chunk))
-            yield msg.encode('iso-8859-1') + chunk
-            prefix = '\r\n'
-            time.sleep(0.15) # slow down mjpeg streaming so that it won't use too much cpu or bandwidth
+            (last_frame_id, chunk) = self._next_frame(last_frame_id)
+            if time.time() - last_yield < min_interval:
+                continue    # skip frames instead of sleeping - pacing is driven by new-frame events
+            # Yield the frame separately from the header so the full JPEG is never copied
+            # into a combined bytes object - wsgi writes the parts back-to-back
+            yield b''.join((prefix, hdr, str(len(chunk)).encode('iso-8859-1'), b'\r\n\r\n'))
+            yield chunk
+            prefix = b'\r\n'
+            last_yield = time.time()
       except GeneratorExit:
         pass
 
     def get_snapshot(self):
+        # Wait through a few frame-id increments to make sure we are not returning a stale pic, which will throw off Octolapse
         possible_stale_pics = 3
-        while True:
-            chunk = self.img_q.get()
-            with self._mutex:
-                gap = time.time() - self.last_capture
-                if gap < 0.1:
-                    possible_stale_pics -= 1      # Get a few pics to make sure we are not returning a stale pic, which will throw off Octolapse
-                    if possible_stale_pics <= 0:
-                        break
+        last_frame_id = self._frame_id
+        while possible_stale_pics > 0:
+            (last_frame_id, chunk) = self._next_frame(last_frame_id)
+            possible_stale_pics -= 1
 
         return flask.send_file(io.BytesIO(chunk), mimetype='image/jpeg')
 